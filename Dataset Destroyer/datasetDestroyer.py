@@ -1,9 +1,15 @@
 import configparser
 import os
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from functools import lru_cache
+from itertools import islice
 import cv2
 import numpy as np
 import ffmpeg
-from random import randint, choice, shuffle
+from random import randint, choice, sample
 from tqdm import tqdm
 
 import logging
@@ -32,17 +38,182 @@ jpeg_quality_range = tuple(map(int, config.get('compression', 'jpeg_quality_rang
 webp_quality_range = tuple(map(int, config.get('compression', 'webp_quality_range').split(',')))
 h264_crf_level_range = tuple(map(int, config.get('compression', 'h264_crf_level_range').split(',')))
 hevc_crf_level_range = tuple(map(int, config.get('compression', 'hevc_crf_level_range').split(',')))
+h264_preset = config.get('compression', 'h264_preset', fallback='medium')
+hevc_preset = config.get('compression', 'hevc_preset', fallback='medium')
 size_factor = config.getfloat('scale', 'size_factor')
 scale_algorithms = config.get('scale', 'algorithms').split(',')
 down_up_scale_algorithms = config.get('scale', 'down_up_algorithms').split(',')
 scale_randomize = config.getboolean('scale', 'randomize')
 scale_range = tuple(map(float, config.get('scale', 'range').split(',')))
+area_downscale = config.getboolean('scale', 'area_downscale', fallback=False)
 print_to_image = config.getboolean('main', 'print')
 
+# Scratch buffers returned by release_buffer() for reuse, keyed by shape and dtype. The least recently used ones are
+# dropped once the pool holds more than SCRATCH_BYTES, enough for the float32 noise buffers of a 1080p image, so
+# datasets with many image sizes do not keep dead buffers alive in every worker.
+SCRATCH_BYTES = 64 << 20
+scratch_buffers = OrderedDict()
+scratch_bytes = 0
+# Random bytes that uniform noise is sliced from at a random offset, generated once per worker on first use.
+# Images with more samples than the pool fall back to cv2.randu.
+NOISE_POOL_SIZE = 32 << 20
+noise_pool = None
+
+# Gaussian blurs with both sigmas at or above this are done at half resolution (repeatedly for larger sigmas)
+DUAL_FILTER_SIGMA = 8
+
+# Images handed to a worker at once, the worker reads them ahead while degrading the previous ones
+BATCH_SIZE = 16
+# Threads per worker that read and write images, so disk I/O overlaps with the degradations
+read_pool = ThreadPoolExecutor(max_workers=4)
+write_pool = ThreadPoolExecutor(max_workers=4)
+# Fast PNG compression, the output is usually read back once for training
+WRITE_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1] if output_format == 'png' else []
+
+# OpenCV interpolation flag for every scale algorithm name
+INTERPOLATIONS = {
+    'bicubic': cv2.INTER_CUBIC,
+    'bilinear': cv2.INTER_LINEAR,
+    'box': cv2.INTER_AREA,
+    'nearest': cv2.INTER_NEAREST,
+    'lanczos': cv2.INTER_LANCZOS4
+}
+unknown_scale_algorithms = set(scale_algorithms) - set(INTERPOLATIONS) - {'down_up'}
+if unknown_scale_algorithms:
+    raise ValueError(f"Unknown scale algorithms in config.ini: {', '.join(sorted(unknown_scale_algorithms))}")
+unknown_down_up_algorithms = set(down_up_scale_algorithms) - set(INTERPOLATIONS)
+if unknown_down_up_algorithms:
+    raise ValueError(f"Unknown down_up scale algorithms in config.ini: {', '.join(sorted(unknown_down_up_algorithms))}")
+
+# Buffer size for the ffmpeg pipes, large enough to move a whole frame in a few syscalls
+PIPE_BUFSIZE = 1 << 20
+
+
+@lru_cache(maxsize=64)
+def render_text(text):
+    # Rasterize the text once into a uint8 coverage mask. Most lines carry random parameters and rarely repeat, so
+    # only a few small masks are kept.
+    font_scale = 1.25 * size_factor
+    (text_w, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 2)
+    pad = 2
+    mask = np.zeros((text_h + baseline + 2 * pad, text_w + 2 * pad), dtype=np.uint8)
+    cv2.putText(mask, text, (pad, text_h + pad), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, 2, cv2.LINE_AA)
+    return mask, text_h + pad, pad
+
 
 def print_text_to_image(image, text, order):
-    return cv2.putText(image, f"{order}. {text}", (10, order * 50), cv2.FONT_HERSHEY_SIMPLEX, 1.25 * size_factor,
-                       (255, 0, 0), 2, cv2.LINE_AA)
+    mask, baseline_y, baseline_x = render_text(f"{order}. {text}")
+    # Place the mask so its baseline lands where cv2.putText would draw it, clipped to the image
+    top = order * 50 - baseline_y
+    left = 10 - baseline_x
+    y0, y1 = max(top, 0), min(top + mask.shape[0], image.shape[0])
+    x0, x1 = max(left, 0), min(left + mask.shape[1], image.shape[1])
+    if y0 < y1 and x0 < x1:
+        region = image[y0:y1, x0:x1]
+        alpha = mask[y0 - top:y1 - top, x0 - left:x1 - left].astype(np.float32) / 255
+        color = np.zeros_like(region)
+        color[..., 0] = 255
+        image[y0:y1, x0:x1] = cv2.blendLinear(region, color, 1 - alpha, alpha)
+    return image
+
+
+def write_to_pipe(pipe, data):
+    try:
+        pipe.write(data)
+        pipe.close()
+    except BrokenPipeError:
+        # ffmpeg exited early, the missing output is reported by the reader
+        pass
+
+
+@lru_cache(maxsize=256)
+def ffmpeg_commands(codec, container, width, height, pix_fmt, output_args):
+    # Building the ffmpeg-python graph is repeated for every frame, cache the compiled command lines per codec setting
+    # and frame size. A long-lived ffmpeg per setting is not possible, both encoder and decoder hold back the last
+    # frame until stdin is closed.
+
+    # Encode image using ffmpeg
+    encode_cmd = (
+        ffmpeg
+        .input('pipe:', format='rawvideo', pix_fmt=pix_fmt, s=f'{width}x{height}')
+        .output('pipe:', format=container, vcodec=codec, **dict(output_args))
+        .global_args('-loglevel', 'error')
+        # .global_args('-movflags', 'frag_keyframe+empty_moov')
+        .global_args('-max_muxing_queue_size', '300000')
+        .compile()
+    )
+
+    # Decode compressed video back into image format using ffmpeg. Passthrough stops ffmpeg from duplicating the
+    # single frame to fill the container's frame rate.
+    decode_cmd = (
+        ffmpeg
+        .input('pipe:', format=container)
+        .output('pipe:', format='rawvideo', pix_fmt=pix_fmt, vsync='passthrough')
+        .global_args('-loglevel', 'error')
+        .compile()
+    )
+
+    return encode_cmd, decode_cmd
+
+
+def borrow_buffer(shape, dtype):
+    # Not thread safe, only the worker's main thread degrades images
+    global scratch_bytes
+    key = (shape, np.dtype(dtype))
+    free = scratch_buffers.get(key)
+    if free:
+        buffer = free.pop()
+        if not free:
+            del scratch_buffers[key]
+        scratch_bytes -= buffer.nbytes
+        return buffer
+    return np.empty(shape, dtype=dtype)
+
+
+def release_buffer(buffer):
+    global scratch_bytes
+    key = (buffer.shape, buffer.dtype)
+    scratch_buffers.setdefault(key, []).append(buffer)
+    scratch_buffers.move_to_end(key)
+    scratch_bytes += buffer.nbytes
+    while scratch_bytes > SCRATCH_BYTES:
+        _, free = scratch_buffers.popitem(last=False)
+        scratch_bytes -= sum(buffer.nbytes for buffer in free)
+
+
+def get_noise_pool_slice(shape):
+    global noise_pool
+    size = int(np.prod(shape))
+    if size > NOISE_POOL_SIZE:
+        return None
+    if noise_pool is None:
+        noise_pool = np.frombuffer(np.random.bytes(NOISE_POOL_SIZE), dtype=np.int8)
+    offset = randint(0, NOISE_POOL_SIZE - size)
+    return noise_pool[offset:offset + size].reshape(shape)
+
+
+@lru_cache(maxsize=256)
+def gaussian_kernel(ksize, sigma):
+    # A sigma of 0 derives sigma from ksize, the same way cv2.GaussianBlur does
+    return cv2.getGaussianKernel(ksize, sigma, cv2.CV_32F)
+
+
+def gaussian_blur(image, ksize_x, sigma_x, ksize_y, sigma_y):
+    # Separable Gaussian blur with cached kernels, written back into image
+    if min(sigma_x, sigma_y) >= DUAL_FILTER_SIGMA:
+        # Large blurs barely differ when done on a half size copy with half the sigma, at a quarter of the pixels and
+        # half the kernel size
+        height, width = image.shape[:2]
+        small = cv2.pyrDown(image)
+        small_sigma_x = sigma_x / 2
+        small_sigma_y = sigma_y / 2
+        small = gaussian_blur(small, 2 * int(4 * small_sigma_x + 0.5) + 1, small_sigma_x,
+                              2 * int(4 * small_sigma_y + 0.5) + 1, small_sigma_y)
+        return cv2.pyrUp(small, dstsize=(width, height))
+
+    kernel_x = gaussian_kernel(ksize_x, sigma_x)
+    kernel_y = gaussian_kernel(ksize_y, sigma_y)
+    return cv2.sepFilter2D(image, -1, kernel_x, kernel_y, dst=image)
 
 
 def apply_blur(image):
@@ -56,17 +227,18 @@ def apply_blur(image):
     # Apply blur with chosen algorithm
     if algorithm == 'average':
         ksize = randint(*blur_range)
-        image = cv2.blur(image, (ksize, ksize))
+        # cv2.blur uses running sums and costs the same for any ksize, so large kernels need no special handling
+        image = cv2.blur(image, (ksize, ksize), dst=image)
         text = f"{algorithm} ksize={ksize}"
     elif algorithm == 'gaussian':
         ksize = randint(*blur_range) | 1
-        image = cv2.GaussianBlur(image, (ksize, ksize), 0)
+        image = gaussian_blur(image, ksize, 0, ksize, 0)
         text = f"{algorithm} ksize={ksize}"
     elif algorithm == 'isotropic':
         # Apply isotropic blur using a Gaussian filter with the same standard deviation in both the x and y directions
         sigma = randint(*blur_range)
         ksize = 2 * int(4 * sigma + 0.5) + 1
-        image = cv2.GaussianBlur(image, (ksize, ksize), sigmaX=sigma, sigmaY=sigma)
+        image = gaussian_blur(image, ksize, sigma, ksize, sigma)
         text = f"{algorithm} ksize={ksize} sigma={sigma}"
     elif algorithm == 'anisotropic':
         # Apply anisotropic blur using a Gaussian filter with different standard deviations in the x and y directions
@@ -74,7 +246,7 @@ def apply_blur(image):
         sigma_y = randint(*blur_range)
         ksize_x = 2 * int(4 * sigma_x + 0.5) + 1
         ksize_y = 2 * int(4 * sigma_y + 0.5) + 1
-        image = cv2.GaussianBlur(image, (ksize_x, ksize_y), sigmaX=sigma_x, sigmaY=sigma_y)
+        image = gaussian_blur(image, ksize_x, sigma_x, ksize_y, sigma_y)
         text = f"{algorithm} sigma_x={sigma_x} sigma_y={sigma_y} ksize_x={ksize_x} ksize_y={ksize_y}"
 
     return image, text
@@ -89,30 +261,46 @@ def apply_noise(image):
         algorithm = noise_algorithms[0]
 
     # Apply noise with chosen algorithm
+    # Noise is written by OpenCV into a signed float32 buffer and added onto the image in place with saturation,
+    # negative values darken the image
     if algorithm == 'uniform':
         intensity = randint(*noise_range)
-        noise = np.random.uniform(-intensity, intensity, image.shape)
-        image = cv2.add(image, noise.astype(image.dtype))
+        pool_noise = get_noise_pool_slice(image.shape)
+        if pool_noise is not None:
+            # Scale the pooled int8 samples to +-intensity and add them in a single pass
+            cv2.addWeighted(image, 1, pool_noise, intensity / 127.5, 0, dst=image, dtype=cv2.CV_8U)
+        else:
+            noise = borrow_buffer(image.shape, np.float32)
+            cv2.randu(noise, (-intensity,) * 3, (intensity,) * 3)
+            cv2.add(image, noise, dst=image, dtype=cv2.CV_8U)
+            release_buffer(noise)
         text = f"{algorithm} intensity={intensity}"
     elif algorithm == 'gaussian':
         intensity = randint(*noise_range)
-        noise = np.random.normal(0, intensity, image.shape)
-        image = cv2.add(image, noise.astype(image.dtype))
+        noise = borrow_buffer(image.shape, np.float32)
+        cv2.randn(noise, (0, 0, 0), (intensity,) * 3)
+        cv2.add(image, noise, dst=image, dtype=cv2.CV_8U)
+        release_buffer(noise)
         text = f"{algorithm} intensity={intensity}"
     elif algorithm == 'color':
-        noise = np.zeros_like(image)
+        noise = borrow_buffer(image.shape, np.float32)
         m = (0, 0, 0)
         s = (randint(*noise_range), randint(*noise_range), randint(*noise_range))
         cv2.randn(noise, m, s)
-        image += noise
+        cv2.add(image, noise, dst=image, dtype=cv2.CV_8U)
+        release_buffer(noise)
         text = f"{algorithm} s={s}"
     elif algorithm == 'gray':
-        gray_noise = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
+        gray_noise = borrow_buffer(image.shape[:2], np.float32)
         m = (0,)
         s = (randint(*noise_range),)
         cv2.randn(gray_noise, m, s)
-        gray_noise = gray_noise[..., None]
-        image += gray_noise
+        # Spread the same noise over all three channels
+        noise = borrow_buffer(image.shape, np.float32)
+        cv2.cvtColor(gray_noise, cv2.COLOR_GRAY2BGR, dst=noise)
+        cv2.add(image, noise, dst=image, dtype=cv2.CV_8U)
+        release_buffer(gray_noise)
+        release_buffer(noise)
         text = f"{algorithm} s={s}"
 
     return image, text
@@ -131,13 +319,13 @@ def apply_compression(image):
         quality = randint(*jpeg_quality_range)
         encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
         result, encimg = cv2.imencode('.jpg', image, encode_param)
-        image = cv2.imdecode(encimg, 1).copy()
+        image = cv2.imdecode(encimg, cv2.IMREAD_COLOR)
         text = f"{algorithm} quality={quality}"
     elif algorithm == 'webp':
         quality = randint(*webp_quality_range)
         encode_param = [int(cv2.IMWRITE_WEBP_QUALITY), quality]
         result, encimg = cv2.imencode('.webp', image, encode_param)
-        image = cv2.imdecode(encimg, 1).copy()
+        image = cv2.imdecode(encimg, cv2.IMREAD_COLOR)
         text = f"{algorithm} quality={quality}"
     elif algorithm in ['h264', 'hevc', 'mpeg', 'mpeg2']:
         # Convert image to video format
@@ -151,61 +339,79 @@ def apply_compression(image):
             codec = 'mpeg2video'
         container = 'mpeg'
 
-        # Get CRF level or bitrate from config
+        # Get CRF level or bitrate from config. Only a single intra frame is encoded, so B-frames and a GOP are disabled
         if algorithm == 'h264':
             crf_level = randint(*h264_crf_level_range)
-            output_args = {'crf': crf_level}
+            output_args = {'crf': crf_level, 'preset': h264_preset, 'bf': 0, 'g': 1}
         elif algorithm == 'hevc':
             crf_level = randint(*hevc_crf_level_range)
-            output_args = {'crf': crf_level, 'x265-params': 'log-level=0'}
+            output_args = {'crf': crf_level, 'preset': hevc_preset, 'x265-params': 'log-level=0:bframes=0:keyint=1'}
         elif algorithm == 'mpeg':
             bitrate = config.get('compression', 'mpegbitrate')
-            output_args = {'b': bitrate}
+            output_args = {'b': bitrate, 'bf': 0, 'g': 1}
         elif algorithm == 'mpeg2':
             bitrate = config.get('compression', 'mpeg2bitrate')
-            output_args = {'b': bitrate}
+            output_args = {'b': bitrate, 'bf': 0, 'g': 1}
         else:
             output_args = {}
 
-        # Encode image using ffmpeg
-        process1 = (
-            ffmpeg
-            .input('pipe:', format='rawvideo', pix_fmt='bgr24', s=f'{width}x{height}')
-            .output('pipe:', format=container, vcodec=codec, **output_args)
-            .global_args('-loglevel', 'error')
-            # .global_args('-movflags', 'frag_keyframe+empty_moov')
-            .global_args('-max_muxing_queue_size', '300000')
-            .run_async(pipe_stdin=True, pipe_stdout=True)
-        )
-        process1.stdin.write(image.tobytes())
-        process1.stdin.close()
-
-        # Decode compressed video back into image format using ffmpeg
-        process2 = (
-            ffmpeg
-            .input('pipe:', format=container)
-            .output('pipe:', format='rawvideo', pix_fmt='bgr24')
-            .global_args('-loglevel', 'error')
-            .run_async(pipe_stdin=True, pipe_stdout=True)
-        )
-
-        out, err = process2.communicate(input=process1.stdout.read())
-
+        # The codecs work in YUV 4:2:0, so convert with OpenCV and let the pipes carry I420 at half the size of BGR. I420
+        # needs even dimensions, other frames are sent as BGR and ffmpeg converts them.
+        if width % 2 == 0 and height % 2 == 0:
+            pix_fmt = 'yuv420p'
+            frame = borrow_buffer((height * 3 // 2, width), np.uint8)
+            cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420, dst=frame)
+            decoded = borrow_buffer((height * 3 // 2, width), np.uint8)
+        else:
+            pix_fmt = 'bgr24'
+            frame = np.ascontiguousarray(image)
+            decoded = np.empty((height, width, 3), dtype=np.uint8)
+
+        encode_cmd, decode_cmd = ffmpeg_commands(codec, container, width, height, pix_fmt,
+                                                 tuple(output_args.items()))
+
+        # Pipe the encoder straight into the decoder so the bitstream never passes through Python
+        process1 = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=PIPE_BUFSIZE)
+        process2 = subprocess.Popen(decode_cmd, stdin=process1.stdout, stdout=subprocess.PIPE, bufsize=PIPE_BUFSIZE)
+        process1.stdout.close()
+
+        # Write the frame from a thread while reading the result, so neither end stalls on a full pipe. The frame is
+        # sent from the array's own memory and the decoded frame is read straight into its buffer, without
+        # intermediate bytes copies.
+        writer = threading.Thread(target=write_to_pipe, args=(process1.stdin, frame.data))
+        writer.start()
+        received = process2.stdout.readinto(memoryview(decoded).cast('B'))
+        received += len(process2.stdout.read())
+        writer.join()
+
+        process2.wait()
         process1.wait()
 
-        try:
-            image = np.frombuffer(out, np.uint8).reshape([height, width, 3]).copy()
-            first_arg = list(output_args.items())[0]
-            text = f"{algorithm} {first_arg[0]}={first_arg[1]}"
-        except ValueError as e:
-            logging.error(f'Error reshaping output from ffmpeg: {e}')
+        if received != decoded.nbytes:
+            logging.error(f'Unexpected output size from ffmpeg: {received} bytes, expected {decoded.nbytes}')
             logging.error(f'Image dimensions: {width}x{height}')
-            logging.error(f'ffmpeg stderr output: {err}')
-            raise e
+            logging.error(f'ffmpeg exit codes: encoder={process1.returncode} decoder={process2.returncode}')
+            raise ValueError('ffmpeg did not return exactly one frame')
+
+        if pix_fmt == 'yuv420p':
+            image = cv2.cvtColor(decoded, cv2.COLOR_YUV2BGR_I420)
+            release_buffer(frame)
+            release_buffer(decoded)
+        else:
+            image = decoded
+        first_arg = list(output_args.items())[0]
+        text = f"{algorithm} {first_arg[0]}={first_arg[1]}"
 
     return image, text
 
 
+def scale_algorithm(algorithm, factor):
+    # Optionally use box (INTER_AREA) for strong downscales, where it is both the fastest and the most accurate choice
+    if area_downscale and factor < 0.5:
+        return 'box'
+    return algorithm
+
+
 def apply_scale(image):
     text = ''
     # Calculate new size
@@ -219,14 +425,6 @@ def apply_scale(image):
     else:
         algorithm = scale_algorithms[0]
 
-    interpolation_map = {
-        'bicubic': cv2.INTER_CUBIC,
-        'bilinear': cv2.INTER_LINEAR,
-        'box': cv2.INTER_AREA,
-        'nearest': cv2.INTER_NEAREST,
-        'lanczos': cv2.INTER_LANCZOS4
-    }
-
     if algorithm == 'down_up':
         if scale_randomize:
             algorithm1 = choice(down_up_scale_algorithms)
@@ -235,52 +433,118 @@ def apply_scale(image):
             algorithm1 = down_up_scale_algorithms[0]
             algorithm2 = down_up_scale_algorithms[-1]
         scale_factor = np.random.uniform(*scale_range)
+        algorithm1 = scale_algorithm(algorithm1, scale_factor)
+        algorithm2 = scale_algorithm(algorithm2, size_factor / scale_factor)
+        # scale_factor is drawn per image, so the intermediate size almost never repeats and is not worth pooling
         image = cv2.resize(image, (int(w * scale_factor), int(h * scale_factor)),
-                           interpolation=interpolation_map[algorithm1])
-        image = cv2.resize(image, (new_w, new_h), interpolation=interpolation_map[algorithm2])
+                           interpolation=INTERPOLATIONS[algorithm1])
+        image = cv2.resize(image, (new_w, new_h), interpolation=INTERPOLATIONS[algorithm2])
         if print_to_image:
             text = f"{algorithm} scale1factor={scale_factor:.2f} scale1algorithm={algorithm1} scale2factor={size_factor/scale_factor:.2f} scale2algorithm={algorithm2}"
     else:
-        image = cv2.resize(image, (new_w, new_h), interpolation=interpolation_map[algorithm])
+        algorithm = scale_algorithm(algorithm, size_factor)
+        image = cv2.resize(image, (new_w, new_h), interpolation=INTERPOLATIONS[algorithm])
         if print_to_image:
             text = f"{algorithm} size factor={size_factor}"
 
     return image, text
 
 
-def process_image(image_path):
-    image = cv2.imread(image_path)
+def init_worker():
+    # Forked workers inherit the parent's numpy and OpenCV RNG state, reseed so every worker produces different noise
+    np.random.seed()
+    cv2.setRNGSeed(randint(0, 2 ** 31 - 1))
+    # The pool already runs one worker per core, OpenCV's own thread pool would only oversubscribe the cores
+    cv2.setNumThreads(1)
 
-    degradation_order = degradations.copy()
-    all_text = []
+
+# Degradation function for every degradation name
+DEGRADATION_FUNCTIONS = {
+    'blur': apply_blur,
+    'noise': apply_noise,
+    'compression': apply_compression,
+    'scale': apply_scale,
+}
+unknown_degradations = set(degradations) - set(DEGRADATION_FUNCTIONS)
+if unknown_degradations:
+    raise ValueError(f"Unknown degradations in config.ini: {', '.join(sorted(unknown_degradations))}")
+
+# Degradation functions in the configured order, resolved once instead of comparing names for every image
+DEGRADATIONS = tuple((degradation, DEGRADATION_FUNCTIONS[degradation]) for degradation in degradations)
+
+
+def process_image(image):
     if degradations_randomize:
-        shuffle(degradation_order)
-    for order, degradation in enumerate(degradation_order, 1):
-        if degradation == 'blur':
-            image, text = apply_blur(image)
-        elif degradation == 'noise':
-            image, text = apply_noise(image)
-        elif degradation == 'compression':
-            image, text = apply_compression(image)
-        elif degradation == 'scale':
-            image, text = apply_scale(image)
+        degradation_order = sample(DEGRADATIONS, len(DEGRADATIONS))
+    else:
+        degradation_order = DEGRADATIONS
+    all_text = []
+    for degradation, apply_degradation in degradation_order:
+        image, text = apply_degradation(image)
         all_text.append(f"{degradation} {text}")
 
     if print_to_image:
         for order, text in enumerate(all_text, 1):
             image = print_text_to_image(image, text, order)
 
+    return image
+
+
+def write_image(image_path, image):
     output_path = os.path.join(output_folder, os.path.relpath(image_path, input_folder))
     output_path = os.path.splitext(output_path)[0] + '.' + output_format
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    cv2.imwrite(output_path, image)
-
-
-# Process images recursively
-image_paths = []
-for subdir, dirs, files in os.walk(input_folder):
-    for file in files:
-        image_paths.append(os.path.join(subdir, file))
-
-for image_path in tqdm(image_paths):
-    process_image(image_path)
+    cv2.imwrite(output_path, image, WRITE_PARAMS)
+
+
+def walk_images(folder):
+    # Yield file paths as they are found so processing starts before the whole tree is listed. Like os.walk, symlinked
+    # directories are neither followed nor returned as files, and unreadable directories are skipped.
+    try:
+        entries = os.scandir(folder)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_images(entry.path)
+            elif not entry.is_dir():
+                yield entry.path
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def process_images(image_paths):
+    # map() submits every read at once, so the rest of the batch is loaded while the first images are degraded
+    writes = []
+    for image_path, image in zip(image_paths, read_pool.map(cv2.imread, image_paths)):
+        writes.append(write_pool.submit(write_image, image_path, process_image(image)))
+
+    for write in writes:
+        write.result()
+    return len(image_paths)
+
+
+if __name__ == "__main__":
+    # Images are independent, so spread them over all cores. Workers import this module and read config.ini themselves.
+    # Paths are streamed in as the folder is scanned, with a bounded number of batches waiting in the pool, so the total
+    # is not known up front.
+    max_pending = 2 * os.cpu_count()
+    with tqdm(unit='img') as pbar:
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker) as executor:
+            pending = set()
+            for batch in batched(walk_images(input_folder), BATCH_SIZE):
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pbar.update(future.result())
+                pending.add(executor.submit(process_images, batch))
+            for future in as_completed(pending):
+                pbar.update(future.result())